@@ -7,7 +7,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2016, D.Cato'
 __docformat__ = 'restructuredtext en'
 
-import re
+import os, re, sys, bisect, codecs
 from functools import partial
 
 from PyQt5.Qt import QMenu, QIcon
@@ -16,12 +16,31 @@ from calibre.utils.logging import GUILog, ANSIStream
 from calibre.gui2 import error_dialog
 from calibre.gui2.actions import InterfaceAction, menu_action_unique_name
 
-from calibre_plugins.exec_macro.config import prefs
+from calibre_plugins.exec_macro.config import prefs, sorted_macro_names
 
 from calibre_plugins.exec_macro.config import show_config_dialog
 from calibre_plugins.exec_macro.config import ConfigWidget
 
 
+# Compiled macro code objects, keyed by macro name.
+# Each entry is a (key, code) pair, where key identifies the source the code
+# was compiled from (the program itself or file path and mtime).
+_code_cache = {}
+
+# PEP 263 source encoding declaration, and the blank/comment-only line that
+# may precede it.
+_DECL_RE = re.compile(r'^[ \t\f]*#.*coding[:=][ \t]*([-\w.]+)')
+_BLANK_RE = re.compile(r'^[ \t\f]*(?:[#\r\n]|$)')
+
+def _first_two_lines(txt):
+    # Only the first two lines can hold the declaration, so avoid
+    # splitting (and copying) the rest of the program.
+    nl = b'\n' if isinstance(txt, bytes) else '\n'
+    end = txt.find(nl)
+    if end >= 0:
+        end = txt.find(nl, end + 1)
+    return txt if end < 0 else txt[:end]
+
 class ExecMacroAction(InterfaceAction):
 
     name = 'Exec Macro'
@@ -33,8 +52,16 @@ class ExecMacroAction(InterfaceAction):
         # This method is called once per plugin, do initial setup here
         self.menu = QMenu(self.gui)
         self.actions = {}
+        # Full unique names of the shortcuts this plugin has registered
+        self._registered_shortcuts = set()
+        # Name of the macro whose menu icon is currently shown
+        self._current_action_name = None
         self.rebuild_menu()
 
+        # Base namespace for macros, built once; execute() only copies it.
+        self._exec_base = {k: v for k, v in globals().items()
+                           if not k.startswith('__')}
+
         self.qaction.setMenu(self.menu)
         self.qaction.setIcon(get_icons('images/icon.png'))
         self.qaction.triggered.connect(self.execute_current_macro)
@@ -43,35 +70,92 @@ class ExecMacroAction(InterfaceAction):
         self.menu.clear()
         self.actions.clear()
 
-        macros = prefs['macros']
-        for name in sorted(macros):
-            action = self.create_menu_action_unique(self.menu, name,
-                tooltip=macros[name]['documentation'],
-                image='dot_red.png', shortcut=None, shortcut_name=None,
-                triggered=partial(self.execute_macro, name))
-            self.actions[name] = action
-        self.mark_current_macro()
+        for name in sorted_macro_names():
+            self.actions[name] = self.create_macro_action(name)
+        self._current_action_name = prefs['current_macro']
 
-        self.menu.addSeparator()
+        self._separator = self.menu.addSeparator()
         self.create_menu_action_unique(self.menu, _('Manage macros'), tooltip=None,
             image='config.png', shortcut=None, shortcut_name=None,
             triggered=partial(show_config_dialog, self))
 
         self.delete_orphan_shortcuts()
 
+    def update_menu(self, added=(), removed=()):
+        '''
+        Update the menu for changed macros instead of rebuilding it.
+        added are names saved or imported (new or overwritten) and removed
+        are names deleted.
+        prefs['macros'] and sorted_macro_names() must already be updated.
+        '''
+        removed_any = False
+        for name in removed:
+            action = self.actions.pop(name, None)
+            if action is None:
+                continue
+            self.menu.removeAction(action)
+            action.deleteLater()
+            removed_any = True
+
+        added_any = False
+        macros = prefs['macros']
+        names = sorted_macro_names()
+        # Insert from the last name backwards, so the following name in
+        # the sorted list always has its action already.
+        for name in sorted(added, reverse=True):
+            action = self.actions.get(name)
+            if action is not None:
+                doc = macros[name]['documentation']
+                action.setToolTip(doc)
+                action.setStatusTip(doc)
+                action.setWhatsThis(doc)
+                continue
+            idx = bisect.bisect_right(names, name)
+            if idx < len(names):
+                before = self.actions[names[idx]]
+            else:
+                before = self._separator
+            action = self.create_macro_action(name)
+            # create_menu_action() appends to the menu, move it into place
+            self.menu.removeAction(action)
+            self.menu.insertAction(before, action)
+            self.actions[name] = action
+            added_any = True
+
+        if removed_any:
+            self.delete_orphan_shortcuts()
+        elif added_any:
+            self.gui.keyboard.finalize()
+
+    def create_macro_action(self, name):
+        action = self.create_menu_action_unique(self.menu, name,
+            tooltip=prefs['macros'][name]['documentation'],
+            image='dot_red.png', shortcut=None, shortcut_name=None,
+            triggered=partial(self.execute_macro, name))
+        action.setIconVisibleInMenu(name == prefs['current_macro'])
+        return action
+
     def delete_orphan_shortcuts(self):
-        prefix = menu_action_unique_name(self, '')
-        to_del = {sc for sc in self.gui.keyboard.shortcuts if sc.startswith(prefix)}
-        new_sc = {menu_action_unique_name(self, name) for name in self.actions}
-        new_sc.add(menu_action_unique_name(self, _('Manage macros')))
-        to_del -= new_sc
+        # Compare bare names rather than formatting a unique name per action
+        prefix_len = len(menu_action_unique_name(self, ''))
+        new_bare = set(self.actions)
+        new_bare.add(_('Manage macros'))
+        to_del = {sc for sc in self._registered_shortcuts
+                  if sc[prefix_len:] not in new_bare}
         for sc in to_del:
             self.gui.keyboard.unregister_shortcut(sc)
+        self._registered_shortcuts -= to_del
         self.gui.keyboard.finalize()
 
     def mark_current_macro(self):
-        for name, action in self.actions.iteritems():
-            action.setIconVisibleInMenu(name == prefs['current_macro'])
+        current = prefs['current_macro']
+        if current == self._current_action_name:
+            return
+        for name, visible in ((self._current_action_name, False), (current, True)):
+            action = self.actions.get(name)
+            if action is not None:
+                action.setIconVisibleInMenu(visible)
+        self._current_action_name = current
 
     def execute_current_macro(self):
         self.execute_macro(prefs['current_macro'])
@@ -89,14 +173,31 @@ class ExecMacroAction(InterfaceAction):
         log.outputs.append(ANSIStream())
         try:
             if macro.get('execfromfile'):
-                with open(macro['macrofile'], 'rU') as file:
-                    self.execute(file, log)
+                filename = macro['macrofile']
+                key = (filename, os.stat(filename).st_mtime)
+                code = self.get_cached_code(name, key)
+                if code is None:
+                    with open(filename, 'rb') as file:
+                        src = file.read()
+                    # compile() honours the coding declaration of byte
+                    # source, undeclared files are compiled as UTF-8 text
+                    # like the editor does.
+                    encoding, program = self.decode_source(src)
+                    # The path only labels tracebacks, it must not fail here
+                    code = self.compile_macro(name, key,
+                        src if encoding else program, filename.encode(
+                        sys.getfilesystemencoding() or 'utf-8', 'replace'))
+                self.execute(code, log)
             elif macro['program']:
                 program = macro['program']
-                encoding = self.get_encoding(program)
-                if encoding:
-                    program = program.encode(encoding)
-                self.execute(program, log)
+                key = program
+                code = self.get_cached_code(name, key)
+                if code is None:
+                    encoding = self.get_encoding(program)
+                    if encoding:
+                        program = program.encode(encoding)
+                    code = self.compile_macro(name, key, program)
+                self.execute(code, log)
         except:
             log.exception(_('Failed to execute macro'))
             error_dialog(self.gui, _('Failed to execute macro'), _(
@@ -104,13 +205,34 @@ class ExecMacroAction(InterfaceAction):
                  det_msg=log.plain_text, show=True)
 
 
+    def get_cached_code(self, name, key):
+        entry = _code_cache.get(name)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        return None
 
-    def execute(self, program, log):
-        # exec(program, globals().copy(), locals().copy())
-        vars = globals().copy()
+    def compile_macro(self, name, key, program, filename=None):
+        if filename is None:
+            filename = self.macro_filename(name)
+        code = compile(program, filename, 'exec')
+        _code_cache[name] = (key, code)
+        return code
+
+    def macro_filename(self, name):
+        # compile() would encode a unicode filename as ASCII on Python 2
+        return ('<macro:%s>' % name).encode('utf-8')
+
+    def invalidate_code_cache(self, names):
+        for name in names:
+            _code_cache.pop(name, None)
+
+    def execute(self, code, log):
+        # A fresh copy per run, since macros may bind names at their top
+        # level and those must not leak into the next execution.
+        vars = self._exec_base.copy()
         vars['self'] = self
         vars['log'] = log
-        exec(program, vars)
+        exec(code, vars)
 
 
     def create_menu_action_unique(self, parent_menu, menu_text, image=None, tooltip=None,
@@ -141,6 +263,7 @@ class ExecMacroAction(InterfaceAction):
 
         ac = self.create_menu_action(parent_menu, unique_name, menu_text, icon=None, shortcut=shortcut,
             description=tooltip, triggered=triggered, shortcut_name=shortcut_name)
+        self._registered_shortcuts.add(ac.calibre_shortcut_unique_name)
         if shortcut == False and not orig_shortcut == False:
             if ac.calibre_shortcut_unique_name in self.gui.keyboard.shortcuts:
                 kb.replace_action(ac.calibre_shortcut_unique_name, ac)
@@ -153,21 +276,27 @@ class ExecMacroAction(InterfaceAction):
 
         return ac
 
-    def get_encoding(self, txt):
-        decl_re = re.compile(r'^[ \t\f]*#.*coding[:=][ \t]*([-\w.]+)')
-        blank_re = re.compile(r'^[ \t\f]*(?:[#\r\n]|$)')
+    def decode_source(self, raw):
+        '''
+        Return the encoding declared in the first two lines of raw, or None,
+        and raw decoded with it, or as UTF-8 when nothing is declared.
+        '''
+        if raw.startswith(codecs.BOM_UTF8):
+            raw = raw[len(codecs.BOM_UTF8):]
+        encoding = self.get_encoding(
+            _first_two_lines(raw).decode('latin-1', 'replace'))
+        return encoding, raw.decode(encoding or 'utf-8')
 
-        lines = txt.splitlines()
+    def get_encoding(self, txt):
+        lines = _first_two_lines(txt).split('\n')
 
-        if len(lines) < 1:
-            return None
-        match = decl_re.match(lines[0])
+        match = _DECL_RE.match(lines[0])
         if match:
             return match.group(1)
 
-        if len(lines) < 2 or (not blank_re.match(lines[0])):
+        if len(lines) < 2 or (not _BLANK_RE.match(lines[0])):
             return None
-        match = decl_re.match(lines[1])
+        match = _DECL_RE.match(lines[1])
         if match:
             return match.group(1)
 
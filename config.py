@@ -5,10 +5,10 @@ __license__   = 'GPL v3'
 __copyright__ = '2016, D.Cato'
 __docformat__ = 'restructuredtext en'
 
-import sys, copy, json, traceback
+import sys, copy, json, bisect, traceback
 from xml.sax.saxutils import escape
 
-from PyQt5.Qt import (QObject, QApplication, QWidget, QIcon, QTextCursor,
+from PyQt5.Qt import (QObject, QApplication, QWidget, QIcon, QTextCursor, QTimer,
         pyqtSignal, QDialog, QDialogButtonBox, QVBoxLayout)
 
 
@@ -23,6 +23,23 @@ from calibre.gui2.widgets import PythonHighlighter
 
 from calibre_plugins.exec_macro.config_ui import Ui_Form
 
+# Use ujson for import/export when available, it is much faster than the
+# stdlib json on large macro bodies.
+try:
+    import ujson
+
+    _loads = ujson.loads
+
+    def _dumps(obj):
+        return ujson.dumps(obj, sort_keys=True, indent=4,
+                           escape_forward_slashes=False).encode('utf-8')
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(obj):
+        return json.dumps(obj, sort_keys=True, indent=4,
+                          separators=(',', ': ')).encode('utf-8')
+
 
 # This is where all preferences for this plugin will be stored
 # Remember that this name (i.e. plugins/interface_demo) is also
@@ -46,6 +63,33 @@ result = info_dialog(self.gui, 'Greetings',
 },
 }
 
+# Sorted names of prefs['macros'], kept in sync by the config widget so the
+# macro box and menu do not need to sort on every edit.
+_sorted_names = None
+
+def sorted_macro_names():
+    global _sorted_names
+    if _sorted_names is None:
+        _sorted_names = sorted(prefs['macros'])
+    return _sorted_names
+
+def add_sorted_macro_name(name):
+    # Without a cache it is built from prefs['macros'] on next use
+    if _sorted_names is not None:
+        idx = bisect.bisect_left(_sorted_names, name)
+        if idx == len(_sorted_names) or _sorted_names[idx] != name:
+            _sorted_names.insert(idx, name)
+
+def remove_sorted_macro_name(name):
+    if _sorted_names is not None:
+        idx = bisect.bisect_left(_sorted_names, name)
+        if idx < len(_sorted_names) and _sorted_names[idx] == name:
+            del _sorted_names[idx]
+
+def reset_sorted_macro_names():
+    global _sorted_names
+    _sorted_names = None
+
 
 help_text = _('''
 <p>Here you can add and remove macros executed from Exec Macro plugin. A
@@ -128,6 +172,8 @@ def show_config_dialog(ia):
     config_widget.scroll_function_names_box(prefs['current_macro'])
 
 def hide_config_dialog():
+    # Setting the geometry commits prefs, pending macro changes included
+    config_widget.cancel_pending_commit()
     prefs['config_dialog_geometry'] = bytearray(config_dialog.saveGeometry())
     config_dialog.hide()
 
@@ -166,9 +212,25 @@ class ConfigWidget(QWidget, Ui_Form):
         self.program.setTabStopWidth(20)
         self.highlighter = PythonHighlighter(self.program.document())
 
+        # Log output is buffered and inserted at most every 33ms
+        self._log_buffer = []
+        self._log_timer = QTimer(self)
+        self._log_timer.setSingleShot(True)
+        self._log_timer.setInterval(33)
+        self._log_timer.timeout.connect(self._flush_log)
+
+        # Saves and deletes are committed to disk once the user pauses
+        self._pending_commit_timer = QTimer(self)
+        self._pending_commit_timer.setSingleShot(True)
+        self._pending_commit_timer.setInterval(500)
+        self._pending_commit_timer.timeout.connect(prefs.commit)
+        QApplication.instance().aboutToQuit.connect(self.flush_pending_commit)
+
         self.build_function_names_box()
 
     def execute_button_clicked(self):
+        name = self.function_name.currentText()
+        filename = self.ia.macro_filename(name)
         try:
             log = GUILog()
             log.outputs.append(QtLogStream())
@@ -178,20 +240,27 @@ class ConfigWidget(QWidget, Ui_Form):
             if self.fromfile_checkbox.isChecked():
                 self.load_file_button_clicked()
 
-            program = self.program.toPlainText()
-            encoding = self.ia.get_encoding(program)
-            if encoding:
-                program = program.encode(encoding)
-
+            del self._log_buffer[:]
             self.textBrowser.clear()
 
-            self.ia.execute(program, log)
+            # The editor's program is cached under the None slot, keyed on
+            # the document revision so that any edit forces a recompile.
+            key = (name, self.program.document().revision())
+            code = self.ia.get_cached_code(None, key)
+            if code is None:
+                program = self.program.toPlainText()
+                encoding = self.ia.get_encoding(program)
+                if encoding:
+                    program = program.encode(encoding)
+                code = self.ia.compile_macro(None, key, program, filename)
+
+            self.ia.execute(code, log)
         except:
             log.exception('Failed to execute macro:')
 
             lineno = 0
             for tb in traceback.extract_tb(sys.exc_info()[2]):
-                if tb[0] == '<string>':
+                if tb[0] == filename:
                     lineno = tb[1]
             if 0 < lineno:
                 self.program.go_to_line(lineno)
@@ -204,8 +273,8 @@ class ConfigWidget(QWidget, Ui_Form):
             return
 
         try:
-            with open(filenames[0], 'r') as fd:
-                new_macros = json.load(fd)
+            with open(filenames[0], 'rb') as fd:
+                new_macros = _loads(fd.read())
             overwrite = sorted(new_macros.viewkeys() & prefs['macros'].viewkeys())
             if not question_dialog(self, _('Some macros will be overwitten'),
                     _('Imported file contains already exists macro,'
@@ -214,9 +283,11 @@ class ConfigWidget(QWidget, Ui_Form):
                 return
 
             prefs['macros'].update(new_macros)
+            reset_sorted_macro_names()
+            self.ia.invalidate_code_cache(new_macros)
             self.build_function_names_box()
             self.scroll_function_names_box(self.function_name.currentText())
-            self.ia.rebuild_menu()
+            self.ia.update_menu(added=new_macros)
             prefs.commit()
 
             info_dialog(self, _('Macros imported'),
@@ -234,8 +305,8 @@ class ConfigWidget(QWidget, Ui_Form):
             return
         try:
 
-            with open(filename, 'w') as fd:
-                json.dump(prefs['macros'], fd, sort_keys=True, indent=4)
+            with open(filename, 'wb') as fd:
+                fd.write(_dumps(prefs['macros']))
 
             info_dialog(self, _('Macros exported'),
                 _('%d macros exported.') % len(prefs['macros']), show=True)
@@ -278,11 +349,9 @@ class ConfigWidget(QWidget, Ui_Form):
             return
 
         try:
-            with open(self.macrofile.text(), 'rU') as fd:
-                program = fd.read()
-                encoding = self.ia.get_encoding(program)
-                if encoding:
-                    program = program.decode(encoding)
+            with open(filename, 'rb') as fd:
+                raw = fd.read()
+            encoding, program = self.ia.decode_source(raw)
 
             self.program.setPlainText(program)
 
@@ -311,21 +380,22 @@ class ConfigWidget(QWidget, Ui_Form):
         name = self.function_name.currentText()
         if name in prefs['macros']:
             del prefs['macros'][name]
-            prefs.commit()
+            remove_sorted_macro_name(name)
+            self.ia.invalidate_code_cache([name])
+            self._pending_commit_timer.start()
             self.save_button.setEnabled(True)
             self.delete_button.setEnabled(False)
             self.build_function_names_box(set_to=name)
-            self.ia.rebuild_menu()
+            self.ia.update_menu(removed=[name])
         else:
             error_dialog(self, _('Exec Macro'),
                          _('Macro not defined'), show=True)
 
     def build_function_names_box(self, set_to=''):
         self.function_name.blockSignals(True)
-        func_names = sorted(prefs['macros'])
         self.function_name.clear()
         self.function_name.addItem('')
-        self.function_name.addItems(func_names)
+        self.function_name.addItems(sorted_macro_names())
         self.function_name.setCurrentIndex(0)
         if set_to:
             self.function_name.setEditText(set_to)
@@ -350,10 +420,20 @@ class ConfigWidget(QWidget, Ui_Form):
             'documentation': self.documentation.toPlainText(),
             'program': self.program.toPlainText(),
         }
+        add_sorted_macro_name(name)
+        self.ia.invalidate_code_cache([name])
         self.build_function_names_box()
         self.scroll_function_names_box(name)
-        self.ia.rebuild_menu()
-        prefs.commit()
+        self.ia.update_menu(added=[name])
+        self._pending_commit_timer.start()
+
+    def flush_pending_commit(self):
+        if self._pending_commit_timer.isActive():
+            self._pending_commit_timer.stop()
+            prefs.commit()
+
+    def cancel_pending_commit(self):
+        self._pending_commit_timer.stop()
 
 
     def function_name_edited(self, txt):
@@ -385,13 +465,21 @@ class ConfigWidget(QWidget, Ui_Form):
             self.save_button.setEnabled(False)
 
     def log_outputted(self, txt):
-        self.textBrowser.moveCursor(QTextCursor.End)
+        self._log_buffer.append(txt)
+        if not self._log_timer.isActive():
+            self._log_timer.start()
+
+    def _flush_log(self):
+        if not self._log_buffer:
+            return
+        # A single <pre> for the whole batch, separate ones would add
+        # blank lines between the entries.
         text = (u'<pre style="margin-top:0px; margin-bottom:0px;">'
-                + txt + u'</pre>')
+                + u''.join(self._log_buffer) + u'</pre>')
+        del self._log_buffer[:]
+        self.textBrowser.moveCursor(QTextCursor.End)
         self.textBrowser.insertHtml(text)
         self.textBrowser.moveCursor(QTextCursor.End)
-        self.textBrowser.repaint()
-        QApplication.processEvents()
 
     def refresh_gui(self, gui):
         pass
@@ -412,45 +500,48 @@ class QtLogStream(HTMLStream, QObject):
         sep  = kwargs.get(u'sep', u' ')
         end  = kwargs.get(u'end', u'\n')
 
-        html = u''
-        text = u''
+        pieces = []
         for arg in args:
             if isbytestring(arg):
                 arg = force_unicode(arg)
             elif not isinstance(arg, unicode):
                 arg = as_unicode(arg)
-            html += arg + sep
-            text += arg + sep
+            pieces.append(arg)
+        text = sep.join(pieces) + end
 
-        self.html_log.emit(self.color[level] + escape(html + end) + self.normal)
-        self.plain_text_log.emit(text + end)
+        self.html_log.emit(self.color[level] + escape(text) + self.normal)
+        self.plain_text_log.emit(text)
 
 
 if __name__ == '__main__':
-    import sys
+    import sys, re
+
+    pat = re.compile(r'''(['"]):/images/([^'"]+)\1''')
+    def sub(match):
+        ans = 'I(%s%s%s)'%(match.group(1), match.group(2), match.group(1))
+        return ans
+    transdef_pat = re.compile(r'^\s+_translate\s+=\s+QtCore.QCoreApplication.translate$', flags=re.M)
+    transpat = re.compile(r'_translate\s*\(.+?,\s+"(.+?)(?<!\\)"\)', re.DOTALL)
+    fixed_subs = {
+        'import images_rc': '',
+        '_("MMM yyyy")': '"MMM yyyy"',
+        '_("d MMM yyyy")': '"d MMM yyyy"',
+    }
+    fixed_pat = re.compile('|'.join(re.escape(k) for k in fixed_subs))
 
     # compile config.ui to config_ui.py
     # usage: calibre-debug -e config.py config.ui config_ui.py
     # ref. calibre.gui2.__init__.py#build_forms
     if 2 < len(sys.argv):
-        import re, cStringIO
+        import cStringIO
         from PyQt5.uic import compileUi
 
-        pat = re.compile(r'''(['"]):/images/([^'"]+)\1''')
-        def sub(match):
-            ans = 'I(%s%s%s)'%(match.group(1), match.group(2), match.group(1))
-            return ans
-        transdef_pat = re.compile(r'^\s+_translate\s+=\s+QtCore.QCoreApplication.translate$', flags=re.M)
-        transpat = re.compile(r'_translate\s*\(.+?,\s+"(.+?)(?<!\\)"\)', re.DOTALL)
-
         buf = cStringIO.StringIO()
         compileUi(sys.argv[1], buf)
         dat = buf.getvalue()
-        dat = dat.replace('import images_rc', '')
         dat = transdef_pat.sub('', dat)
         dat = transpat.sub(r'_("\1")', dat)
-        dat = dat.replace('_("MMM yyyy")', '"MMM yyyy"')
-        dat = dat.replace('_("d MMM yyyy")', '"d MMM yyyy"')
+        dat = fixed_pat.sub(lambda m: fixed_subs[m.group(0)], dat)
         dat = pat.sub(sub, dat)
 
         dat = dat.replace('self.program = QtWidgets.QPlainTextEdit(Form)',